@@ -4,7 +4,9 @@ from argparse import ArgumentParser
 import string
 from string import Template
 import linecache
+import json
 
+import errno
 import os.path
 import sys
 import time
@@ -35,7 +37,13 @@ from dxr.utils import connect_db
 #   files -> Special case, just gets a list of matching files by name
 #
 # Lastly, all matches are output to dxr-ctags (file in working directory) in
-# ctags format, allowing editors with ctags support to integrate.
+# ctags format, allowing editors with ctags support to integrate. Results can
+# also go to some other file, or stdout (see --output), and can be written as
+# JSON lines instead (see --format).
+#
+# There is also a prefetch query type, which takes only a file name. It dumps
+# every symbol recorded in that file into dxr-ctags-cache, so that later
+# queries from that file can skip the joins in find_matches_for_token_in.
 
 def is_root(directory):
     return os.path.realpath(directory) == os.path.realpath(os.path.join(directory, '..'))
@@ -70,12 +78,26 @@ def find_dxr_tree():
     print('Found dxr_config, but could not determine our tree')
     return None
 
-def clear_tags_file():
-    tagfile_path = os.path.abspath('dxr-ctags')
-    tagfile = open(tagfile_path, 'w')
-    tagfile.write('')
+# Where query results go, and in what format. Set up by open_tags_output.
+tags_output = None
+tags_output_format = 'ctags'
+
+# Results go to dxr-ctags in the tree's directory by default, but can instead
+# go to a path of the caller's choosing (eg; one per editor session, so two
+# sessions on the same tree don't clobber each other), or to stdout if path is
+# '-'.
+def open_tags_output(path, output_format):
+    global tags_output
+    global tags_output_format
+
+    tags_output_format = output_format
+
+    if path == '-':
+        tags_output = sys.__stdout__
+    else:
+        tags_output = open(os.path.abspath(path), 'w')
 
-# Takes query results, and writes them to a ctags format file.
+# Takes query results, and writes them out in ctags format (or as JSON lines).
 # (This is the easiest way to get vim integration; we set up a bunch of bindings
 # that will call this script with the necessary arguments, and then kick vim's
 # ctags integration to pull in the results. A little weird, but it works.)
@@ -93,8 +115,6 @@ def query_and_write_tags_file(conn, query, token, sql_parameters = {}):
     if start_time is not None:
         print((time.time() * 1000) - start_time)
 
-    tagfile_path = os.path.abspath('dxr-ctags')
-    tagfile = open(tagfile_path, 'a')
     for row in res:
         filename = row[0]
         line_number = row[1]
@@ -103,9 +123,50 @@ def query_and_write_tags_file(conn, query, token, sql_parameters = {}):
         # Would be very nice if dxr recorded line contents, this will be kinda
         # sad if line-numbers change, but GNU global does the same thing
         line = linecache.getline(filename, line_number).strip()
-        tagfile.write("%s\t%s\t%d;\"\tqualname:<<<%s>>>\tline:%s \n" % (token, filename, line_number, qualname, line))
+        # Source files aren't always valid utf-8; better a few odd characters
+        # than losing the rest of the results.
+        line = line.decode('utf-8', 'replace')
+        # The output might not live in the tree's directory, so relative paths
+        # won't work for whoever reads it.
+        path = os.path.abspath(filename)
+        if tags_output_format == 'json':
+            tags_output.write(json.dumps({
+                'token'    : token,
+                'path'     : path,
+                'line'     : line_number,
+                'col'      : column,
+                'qualname' : qualname,
+                'text'     : line
+            }) + "\n")
+        else:
+            tag = "%s\t%s\t%d;\"\tqualname:<<<%s>>>\tline:%s \n" % (token, path, line_number, qualname, line)
+            tags_output.write(tag.encode('utf-8'))
+
+    tags_output.flush()
+
+def find_file_id(conn, from_file):
+    query = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS matching_files AS
+        SELECT files.id FROM files
+        WHERE files.path LIKE :from_file
+    """
+    conn.execute(query, {'from_file' : '%' + from_file})
+
+    # SQLite keeps picking bad query plans where matching_files isn't
+    # the outer loop, even when it is a temp table of size 1.
+    # So, we force the issue.
+    query = """
+        SELECT id FROM matching_files LIMIT 1
+    """
+
+    res = conn.execute(query)
 
-    tagfile.close()
+    row = res.fetchone()
+
+    if row is None:
+        return None
+
+    return row[0]
 
 def find_matches_for_token_in(conn,
                               table_to_search,
@@ -124,29 +185,11 @@ def find_matches_for_token_in(conn,
             """
         queries_to_union.append(Template(query).substitute(**locals()))
     else:
-        query = """
-            CREATE TEMPORARY TABLE IF NOT EXISTS matching_files AS
-            SELECT files.id FROM files
-            WHERE files.path LIKE :from_file
-        """
-        conn.execute(query, {'from_file' : '%' + from_file})
-
-        # SQLite keeps picking bad query plans where matching_files isn't
-        # the outer loop, even when it is a temp table of size 1.
-        # So, we force the issue.
-        query = """
-            SELECT id FROM matching_files LIMIT 1
-        """
-
-        res = conn.execute(query)
+        file_id = find_file_id(conn, from_file)
 
-        row = res.fetchone()
-
-        if row is None:
+        if file_id is None:
             return None
 
-        file_id = row[0]
-
         for table in match_file_and_line_in:
             table_with_file_and_line = table['table']
             join_key = table['join_key']
@@ -196,6 +239,205 @@ def find_matches_for_token_in(conn,
 
     return temp_table_name
 
+# The file and line number of a token observed in a source file could be
+# recorded in many different tables, depending on how the token was
+# categorized. For each kind of thing a token might be (the table we'd search
+# for it in), these are the tables that record where it shows up.
+symbol_tables = [
+    {
+        'kind' : 'functions',
+        'match_file_and_line_in' : [
+            # Gratuitous join, but no big deal
+            # Covers function definitions, and declarations for pure virtual
+            # functions
+            {'table' : 'functions',           'join_key' : 'id'},
+            # Covers function references; this includes function calls, and
+            # converting to function pointers.
+            {'table' : 'function_refs',       'join_key' : 'refid'},
+            # Covers function declarations, unless pure virtual
+            {'table' : 'function_decldef',    'join_key' : 'defid'}
+        ]
+    },
+    {
+        'kind' : 'macros',
+        'match_file_and_line_in' : [
+            # Gratuitous join, but no big deal
+            # Covers macro definitions
+            {'table' : 'macros',           'join_key' : 'id'},
+            # Covers macro references
+            {'table' : 'macro_refs',       'join_key' : 'refid'},
+        ]
+    },
+    # BUG?: Stuff like "friend class Foo" is not recorded anywhere in dxr,
+    # so contextual clues are worthless for them.
+    {
+        'kind' : 'types',
+        'match_file_and_line_in' : [
+            # Gratuitous join, but no big deal
+            # Covers type definitions
+            {'table' : 'types',           'join_key' : 'id'},
+            # Covers type references
+            {'table' : 'type_refs',       'join_key' : 'refid'},
+        ]
+    },
+    {
+        'kind' : 'typedefs',
+        'match_file_and_line_in' : [
+            # Gratuitous join, but no big deal
+            # Covers type definitions
+            {'table' : 'typedefs',          'join_key' : 'id'},
+            # Covers type references
+            {'table' : 'typedef_refs',       'join_key' : 'refid'},
+        ]
+    },
+    {
+        'kind' : 'variables',
+        'match_file_and_line_in' : [
+            # Gratuitous join, but no big deal
+            # Covers variable definitions
+            {'table' : 'variables',           'join_key' : 'id'},
+            # Covers variable references
+            {'table' : 'variable_refs',       'join_key' : 'refid'},
+            # Covers variable declarations
+            {'table' : 'variable_decldef',    'join_key' : 'defid'}
+        ]
+    }
+]
+
+# Prefetched symbol maps live here, one per source file, so that lookups that
+# start from a file we've already opened don't need to join against every
+# *_refs table again.
+def symbol_map_dir():
+    return os.path.abspath('dxr-ctags-cache')
+
+# Changes whenever the index is rebuilt, so we don't trust maps built from an
+# older index. The size alone won't do (sqlite files grow a page at a time),
+# and neither will whole-second mtimes; a replaced db also gets a new inode.
+def index_generation(conn):
+    for row in conn.execute('PRAGMA database_list'):
+        if row[1] == 'main':
+            stat = os.stat(row[2])
+            return '%s-%d-%d' % (repr(stat.st_mtime), stat.st_size, stat.st_ino)
+    return None
+
+def symbol_map_path(conn, file_id):
+    return os.path.join(symbol_map_dir(), '%d.%s' % (file_id, index_generation(conn)))
+
+# Pulls every symbol recorded anywhere in the file in one go. Each row is
+# (line, col, token, kind, id), where kind is the table the id is from.
+def build_symbol_map(conn, file_id):
+    queries_to_union = []
+    for symbol_table in symbol_tables:
+        table_to_search = symbol_table['kind']
+        for table in symbol_table['match_file_and_line_in']:
+            table_with_file_and_line = table['table']
+            join_key = table['join_key']
+            query = """
+                SELECT $table_with_file_and_line.file_line,
+                       $table_with_file_and_line.file_col,
+                       results.name,
+                       '$table_to_search',
+                       results.id
+                FROM $table_to_search AS results
+                INNER JOIN $table_with_file_and_line ON
+                    results.id == $table_with_file_and_line.$join_key
+                WHERE $table_with_file_and_line.file_id == :file_id
+            """
+            queries_to_union.append(Template(query).substitute(**locals()))
+
+    final_query = string.join(queries_to_union, ' UNION ') + ';'
+    return conn.execute(final_query, {'file_id' : file_id}).fetchall()
+
+def write_symbol_map(conn, file_id, symbol_map_rows):
+    if not os.path.isdir(symbol_map_dir()):
+        os.makedirs(symbol_map_dir())
+
+    map_path = symbol_map_path(conn, file_id)
+
+    # Write somewhere else and move it into place, so a lookup running at the
+    # same time never sees half a map.
+    tmp_path = '%s.%d.tmp' % (map_path, os.getpid())
+    try:
+        mapfile = open(tmp_path, 'w')
+        for row in symbol_map_rows:
+            # Identifiers aren't always ascii. Store them as utf-8, which is
+            # also what the token we're handed on the command line will be.
+            entry = u"%d\t%d\t%s\t%s\t%d\n" % tuple(row)
+            mapfile.write(entry.encode('utf-8'))
+        mapfile.close()
+        os.rename(tmp_path, map_path)
+    finally:
+        # Don't leave half a map lying around if anything went wrong
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    # Maps built from an older index are useless now, as are half-written ones
+    # left behind by a prefetch against an older index that got interrupted.
+    # Anything for the current index is left alone; another prefetch of this
+    # file might still be writing it.
+    stale_prefix = '%d.' % file_id
+    current_prefix = os.path.basename(map_path)
+    for entry in os.listdir(symbol_map_dir()):
+        if entry.startswith(stale_prefix) and not entry.startswith(current_prefix):
+            try:
+                os.remove(os.path.join(symbol_map_dir(), entry))
+            except OSError as e:
+                # Someone else prefetching this file beat us to it
+                if e.errno != errno.ENOENT:
+                    raise
+
+# Returns the prefetched map for from_file as token -> [(line, kind, id)], or
+# None if it hasn't been prefetched against the current index.
+def load_symbol_map(conn, from_file):
+    file_id = find_file_id(conn, from_file)
+    if file_id is None:
+        return None
+
+    map_path = symbol_map_path(conn, file_id)
+    if not os.path.exists(map_path):
+        return None
+
+    symbol_map = {}
+    mapfile = open(map_path, 'r')
+    for entry in mapfile:
+        (line, col, token, kind, symbol_id) = entry.rstrip('\n').split('\t')
+        symbol_map.setdefault(token, []).append((int(line), kind, int(symbol_id)))
+    mapfile.close()
+
+    return symbol_map
+
+# Same as find_matches_for_token_in, but for every table at once, and using a
+# prefetched symbol map instead of joining against the *_refs tables.
+def find_matches_for_token_in_symbol_map(conn,
+                                         symbol_map,
+                                         token,
+                                         from_line_start,
+                                         from_line_end):
+    ids_by_kind = {}
+    for (line, kind, symbol_id) in symbol_map.get(token, []):
+        if from_line_start is None or from_line_start <= line <= from_line_end:
+            ids_by_kind.setdefault(kind, set()).add(symbol_id)
+
+    matches = {}
+    for symbol_table in symbol_tables:
+        table_to_search = symbol_table['kind']
+        matches[table_to_search] = None
+
+        if table_to_search not in ids_by_kind:
+            continue
+
+        temp_table_name = 'matching_' + table_to_search + '_temp'
+        ids = string.join([str(i) for i in sorted(ids_by_kind[table_to_search])], ', ')
+        query = """
+            CREATE TEMP TABLE $temp_table_name AS
+            SELECT results.* FROM $table_to_search AS results
+            WHERE results.id IN ($ids);
+        """
+        conn.execute(Template(query).substitute(**locals()))
+        matches[table_to_search] = temp_table_name
+
+    return matches
+
 # Builds temporary tables holding matches for token. Easier to read than
 # inner select, and more efficient since we need to reuse.
 # Returns names of temporary tables
@@ -206,100 +448,35 @@ def find_matches_for_token(
         from_line_start=None,
         from_line_end=None):
 
+    # If the file we're in has been prefetched, we can figure out what the
+    # token is without going back to the db.
+    matches = None
+    if from_file is not None:
+        symbol_map = load_symbol_map(conn, from_file)
+        if symbol_map is not None:
+            matches = find_matches_for_token_in_symbol_map(
+                    conn,
+                    symbol_map,
+                    token,
+                    from_line_start,
+                    from_line_end)
+
     # The SQL statements that find every matching variable, function, macro,
     # and type that the token might be referring to, declaring, or defining
     # (ie; "What exactly is this token?")
-
-    # The file and line number of a token observed in a source file could be
-    # recorded in many different tables, depending on how the token was
-    # categorized
-    matching_functions_table = find_matches_for_token_in(
-            conn = conn,
-            table_to_search = 'functions',
-            match_file_and_line_in = [
-                # Gratuitous join, but no big deal
-                # Covers function definitions, and declarations for pure virtual
-                # functions
-                {'table' : 'functions',           'join_key' : 'id'}, 
-                # Covers function references; this includes function calls, and
-                # converting to function pointers.
-                {'table' : 'function_refs',       'join_key' : 'refid'},
-                # Covers function declarations, unless pure virtual
-                {'table' : 'function_decldef',    'join_key' : 'defid'}
-            ],
-            token = token,
-            from_file = from_file,
-            from_line_start = from_line_start,
-            from_line_end = from_line_end)
-
-
-    matching_macros_table = find_matches_for_token_in(
-            conn = conn,
-            table_to_search = 'macros',
-            match_file_and_line_in = [
-                # Gratuitous join, but no big deal
-                # Covers macro definitions
-                {'table' : 'macros',           'join_key' : 'id'}, 
-                # Covers macro references
-                {'table' : 'macro_refs',       'join_key' : 'refid'},
-            ],
-            token = token,
-            from_file = from_file,
-            from_line_start = from_line_start,
-            from_line_end = from_line_end)
-
-
-    # BUG?: Stuff like "friend class Foo" is not recorded anywhere in dxr,
-    # so contextual clues are worthless for them.
-    matching_types_table = find_matches_for_token_in(
-            conn = conn,
-            table_to_search = 'types',
-            match_file_and_line_in = [
-                # Gratuitous join, but no big deal
-                # Covers type definitions
-                {'table' : 'types',           'join_key' : 'id'}, 
-                # Covers type references
-                {'table' : 'type_refs',       'join_key' : 'refid'},
-            ],
-            token = token,
-            from_file = from_file,
-            from_line_start = from_line_start,
-            from_line_end = from_line_end)
-
-    matching_typedefs_table = find_matches_for_token_in(
-            conn = conn,
-            table_to_search = 'typedefs',
-            match_file_and_line_in = [
-                # Gratuitous join, but no big deal
-                # Covers type definitions
-                {'table' : 'typedefs',          'join_key' : 'id'}, 
-                # Covers type references
-                {'table' : 'typedef_refs',       'join_key' : 'refid'},
-            ],
-            token = token,
-            from_file = from_file,
-            from_line_start = from_line_start,
-            from_line_end = from_line_end)
-
-
-    matching_variables_table = find_matches_for_token_in(
-            conn = conn,
-            table_to_search = 'variables',
-            match_file_and_line_in = [
-                # Gratuitous join, but no big deal
-                # Covers variable definitions
-                {'table' : 'variables',           'join_key' : 'id'}, 
-                # Covers variable references
-                {'table' : 'variable_refs',       'join_key' : 'refid'},
-                # Covers variable declarations
-                {'table' : 'variable_decldef',    'join_key' : 'defid'}
-            ],
-            token = token,
-            from_file = from_file,
-            from_line_start = from_line_start,
-            from_line_end = from_line_end)
-
-    if matching_functions_table is None and matching_macros_table is None and matching_types_table is None and matching_typedefs_table is None and matching_variables_table is None:
+    if matches is None:
+        matches = {}
+        for symbol_table in symbol_tables:
+            matches[symbol_table['kind']] = find_matches_for_token_in(
+                    conn = conn,
+                    table_to_search = symbol_table['kind'],
+                    match_file_and_line_in = symbol_table['match_file_and_line_in'],
+                    token = token,
+                    from_file = from_file,
+                    from_line_start = from_line_start,
+                    from_line_end = from_line_end)
+
+    if all(table is None for table in matches.values()):
         if from_line_start is not None:
             print("Found no matches; try ignoring line number")
             return find_matches_for_token(conn, token, from_file)
@@ -307,13 +484,7 @@ def find_matches_for_token(
             print("Found no matches; try ignoring file name and line number")
             return find_matches_for_token(conn, token)
 
-    return {
-        'variables'    : matching_variables_table,
-        'functions'    : matching_functions_table,
-        'macros'       : matching_macros_table,
-        'types'        : matching_types_table,
-        'typedefs'     : matching_typedefs_table
-    }
+    return matches
 
 def query_for_refs(conn, token, from_file, from_line_start, from_line_end):
     matches = find_matches_for_token(conn, token, from_file, from_line_start, from_line_end)
@@ -597,35 +768,74 @@ def query_for_files(conn, token, from_file, from_line_start, from_line_end):
 
     query_and_write_tags_file(conn, query, token, {'token' : '%' + token})
 
-def main():
-    debugfile_path = os.path.abspath('/tmp/dxr-ctags.out')
-    debugfile = open(debugfile_path, 'w')
-    debugfile.write(string.join(sys.argv) + "\n")
-    debugfile.write(os.path.abspath(os.path.curdir))
+# Builds the symbol map for from_file, if we don't already have one for the
+# current index. Meant to be kicked off in the background when the editor opens
+# a file, so later lookups from that file are cheap.
+def query_for_prefetch(conn, token, from_file, from_line_start, from_line_end):
+    if from_file is None:
+        print('Need a file to prefetch')
+        return
 
-    dxr_tree = find_dxr_tree()
-    if dxr_tree is None:
-        return 1
+    file_id = find_file_id(conn, from_file)
+    if file_id is None:
+        print('Could not find ' + from_file + ' in the index')
+        return
 
-    conn = connect_db(dxr_tree.target_folder)
+    if os.path.exists(symbol_map_path(conn, file_id)):
+        return
 
-    clear_tags_file()
+    write_symbol_map(conn, file_id, build_symbol_map(conn, file_id))
 
+def main():
     query_functions = {
         'defs'  : query_for_defs,
         'decls' : query_for_decls,
         'refs'  : query_for_refs,
-        'files'  : query_for_files
+        'files'  : query_for_files,
+        'prefetch' : query_for_prefetch
     }
 
     parser = ArgumentParser(description='Parse command-line arguments for dxrtags')
-    parser.add_argument('-t', '--token', help='The token to search for', required=True)
+    parser.add_argument('-t', '--token', help='The token to search for (not needed for prefetch)')
     parser.add_argument('-q', '--query_type', choices=query_functions.keys(), help='The type of query to perform', required=True)
     parser.add_argument('-f', '--from_file', help='The file the token was discovered in')
     parser.add_argument('-l', '--from_line', type=int, help='The line the token was discovered on')
     parser.add_argument('-w', '--wiggle_room', type=int, default=0, help='Wiggle room for line number')
+    parser.add_argument('-o', '--output', help='Where to write results; - for stdout (default: dxr-ctags next to dxr_config)')
+    parser.add_argument('-F', '--format', choices=['ctags', 'json'], default='ctags', help='Format to write results in')
     args = parser.parse_args()
 
+    if args.query_type != 'prefetch' and args.token is None:
+        parser.error('argument -t/--token is required')
+
+    # Prefetches happen every time the editor opens a file, so they'd bury the
+    # lookup we actually want to debug.
+    if args.query_type != 'prefetch':
+        debugfile_path = os.path.abspath('/tmp/dxr-ctags.out')
+        debugfile = open(debugfile_path, 'w')
+        debugfile.write(string.join(sys.argv) + "\n")
+        debugfile.write(os.path.abspath(os.path.curdir))
+
+    # find_dxr_tree is going to chdir on us
+    output_path = 'dxr-ctags'
+    if args.output is not None:
+        output_path = args.output
+        if output_path != '-':
+            output_path = os.path.abspath(output_path)
+        else:
+            # Everything else we print is chatter, keep it out of the results.
+            sys.stdout = sys.stderr
+
+    dxr_tree = find_dxr_tree()
+    if dxr_tree is None:
+        return 1
+
+    conn = connect_db(dxr_tree.target_folder)
+
+    # Prefetching doesn't produce tags, so leave whatever is in there alone
+    if args.query_type != 'prefetch':
+        open_tags_output(output_path, args.format)
+
     from_line_start = args.from_line;
     from_line_end = args.from_line;
     if args.wiggle_room is not None and args.from_line is not None:
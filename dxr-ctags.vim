@@ -1,48 +1,102 @@
-set tags=dxr-ctags,./dxr-ctags;
+" Where possible, dxr-ctags.py hands results straight back to us on stdout,
+" and we give them to vim's ctags support through 'tagfunc'. Vims without
+" 'tagfunc' get them through a tags file of their own instead, so that other
+" sessions on the same tree don't clobber it.
+let s:use_tagfunc = exists('+tagfunc')
+let s:tagfile = tempname()
+let s:results = []
+if !s:use_tagfunc
+    let &tags = s:tagfile
+endif
 
-" Performs the query we want using dxr-ctags.py, which updates dxr-ctags with
-" only the matches we're interested in. Once this is done, we turn it over to
-" vim's ctags support.
+function s:RunQuery(args)
+    if s:use_tagfunc
+        let command = 'dxr-ctags.py '.a:args.' -o - -F json 2>/dev/null'
+        let s:results = []
+        for line in systemlist(command)
+            let result = json_decode(line)
+            call add(s:results, {'name': result.token, 'filename': result.path, 'cmd': string(result.line), 'kind': '', 'qualname': result.qualname})
+        endfor
+    else
+        call system('dxr-ctags.py '.a:args.' -o '.shellescape(s:tagfile))
+    endif
+endfunction
+
+function DxrTagFunc(pattern, flags, info)
+    return s:results
+endfunction
+
+" 'tagfunc' is local to the buffer, and the jump may well leave us in some
+" other buffer, so put it back on the one we started from.
+function s:Jump(jump_command, token)
+    if s:use_tagfunc
+        let origbuf = bufnr('%')
+        let saved_tagfunc = &l:tagfunc
+        let &l:tagfunc = 'DxrTagFunc'
+        try
+            exe a:jump_command.' '.a:token
+        finally
+            call setbufvar(origbuf, '&tagfunc', saved_tagfunc)
+        endtry
+    else
+        exe a:jump_command.' '.a:token
+    endif
+endfunction
+
+" Performs the query we want using dxr-ctags.py, which hands back only the
+" matches we're interested in. Once this is done, we turn it over to vim's
+" ctags support.
 function PerformQuery(query_type, token)
     let args = '-q '.a:query_type.' -f '.expand('%').' -l '.line('.').' -t '.a:token
-    let command = 'dxr-ctags.py '.args
-    call system(command)
+    call s:RunQuery(args)
 endfunction
 
 function PerformQueryContextFree(query_type, token)
     let args = '-q '.a:query_type.' -t '.a:token
-    let command = 'dxr-ctags.py '.args
+    call s:RunQuery(args)
+endfunction
+
+" Builds dxr-ctags.py's symbol map for a file in the background, so that
+" lookups starting from that file don't have to hit every *_refs table.
+function PrefetchSymbolMap(file)
+    let args = '-q prefetch -f '.shellescape(a:file)
+    let command = 'dxr-ctags.py '.args.' > /dev/null 2>&1 &'
     call system(command)
 endfunction
 
+augroup dxr_ctags
+    autocmd!
+    autocmd BufRead * call PrefetchSymbolMap(expand('<afile>:p'))
+augroup END
+
 function Dxtjump(query_type, token)
     call PerformQuery(a:query_type, a:token)
-    exe "tjump ".a:token
+    call s:Jump('tjump', a:token)
 endfunction
 
 function Dxtjump_cf(query_type, token)
     call PerformQueryContextFree(a:query_type, a:token)
-    exe "tjump ".a:token
+    call s:Jump('tjump', a:token)
 endfunction
 
 function Dxstjump(query_type, token)
     call PerformQuery(a:query_type, a:token)
-    exe "stjump ".a:token
+    call s:Jump('stjump', a:token)
 endfunction
 
 function Dxstjump_cf(query_type, token)
     call PerformQueryContextFree(a:query_type, a:token)
-    exe "stjump ".a:token
+    call s:Jump('stjump', a:token)
 endfunction
 
 function Dxvtjump(query_type, token)
     call PerformQuery(a:query_type, a:token)
-    exe "vert stjump ".a:token
+    call s:Jump('vert stjump', a:token)
 endfunction
 
 function Dxvtjump_cf(query_type, token)
     call PerformQueryContextFree(a:query_type, a:token)
-    exe "vert stjump ".a:token
+    call s:Jump('vert stjump', a:token)
 endfunction
 
 "